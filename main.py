@@ -5,7 +5,10 @@ import re
 import threading
 import time
 import json
-from datetime import date
+import heapq
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from flask import Flask, request
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError
@@ -21,9 +24,11 @@ LINE_CHANNEL_ACCESS_TOKEN = os.getenv('LINE_CHANNEL_ACCESS_TOKEN')
 LINE_CHANNEL_SECRET = os.getenv('LINE_CHANNEL_SECRET')
 SOOCHOW_USERNAME = os.getenv('SOOCHOW_USERNAME')
 SOOCHOW_PASSWORD = os.getenv('SOOCHOW_PASSWORD')
-MONITOR_INTERVAL = 3
+MONITOR_INTERVAL = 5
 MAX_RETRY_ATTEMPTS = 3
+MAX_BACKOFF_SECONDS = 60
 REQUEST_TIMEOUT = 30
+SCHEDULER_WORKERS = int(os.getenv('SCHEDULER_WORKERS', 8))
 PORT = 5000
 HOST = '0.0.0.0'
 MAX_MONITORING_PER_USER = 10
@@ -32,40 +37,128 @@ DEBUG_MODE = False
 app = Flask(__name__)
 line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
-monitoring_data = {}  # {user_id: {course_id: {'course_name': str, 'thread': Thread}}}
+monitoring_data = {}  # {user_id: {course_id: {'course_name': str}}}
+course_polls = {}  # {course_id: {'users': set, 'timer': Timer}}
 monitoring_lock = threading.Lock()
-last_check_date = None
-
-def check_and_clear_monitoring():
-    """Check if monitoring courses need to be cleared on March 1st and October 1st"""
-    global last_check_date
-    current_date = date.today()
-    # Skip if already checked today
-    if last_check_date == current_date:
+
+
+class Timer:
+    """Handle for a callback scheduled on the TimerScheduler"""
+    __slots__ = ('when', 'callback', 'args', 'inline', 'cancelled')
+
+    def __init__(self, when, callback, args, inline=False):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.inline = inline
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerScheduler:
+    """Run all time-based work from a single heap-ordered timer thread"""
+    def __init__(self, max_workers=SCHEDULER_WORKERS):
+        self._heap = []  # [(when, seq, Timer)], ordered by monotonic deadline
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='timer-worker')
+        self._thread = None
+
+    def start(self):
+        """Start the timer thread if it is not running yet"""
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='timer-scheduler', daemon=True)
+                self._thread.start()
+
+    def schedule(self, delay, callback, *args, inline=False):
+        """Run callback(*args) after delay seconds, returns a cancellable Timer
+
+        Inline callbacks run on the timer thread itself and must be short.
+        """
+        self.start()
+        timer = Timer(time.monotonic() + max(delay, 0), callback, args, inline)
+        with self._cond:
+            heapq.heappush(self._heap, (timer.when, next(self._seq), timer))
+            # Wake the timer thread only if the new timer is the earliest one
+            if self._heap[0][2] is timer:
+                self._cond.notify()
+        return timer
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    # Drop cancelled timers lazily instead of searching the heap on cancel
+                    while self._heap and self._heap[0][2].cancelled:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    remaining = self._heap[0][0] - time.monotonic()
+                    if remaining <= 0:
+                        timer = heapq.heappop(self._heap)[2]
+                        break
+                    self._cond.wait(remaining)
+
+            if timer.inline:
+                self._execute(timer)
+            else:
+                self._executor.submit(self._execute, timer)
+
+    def _execute(self, timer):
+        if timer.cancelled:
+            return
+        try:
+            timer.callback(*timer.args)
+        except Exception as e:
+            print(f"Error in scheduled task {getattr(timer.callback, '__name__', timer.callback)}: {e}")
+
+
+scheduler = TimerScheduler()
+
+
+def next_clear_datetime(now=None):
+    """Return the next March 1st or October 1st midnight after now"""
+    now = now or datetime.now()
+    candidates = [datetime(year, month, 1) for year in (now.year, now.year + 1) for month in (3, 10)]
+    return min(candidate for candidate in candidates if candidate > now)
+
+
+def schedule_auto_clear(target=None):
+    """Schedule the semester clear-out for target (defaults to the next one)"""
+    target = target or next_clear_datetime()
+    delay = (target - datetime.now()).total_seconds()
+    # Run inline on the timer thread so busy poll workers cannot delay it
+    scheduler.schedule(delay, auto_clear_monitoring, target, inline=True)
+    print(f"Next auto-clear scheduled for {target} (in {delay / 86400:.1f} days)")
+
+
+def auto_clear_monitoring(target):
+    """Clear all monitoring courses on March 1st and October 1st"""
+    # The monotonic clock may drift from wall-clock time, so re-arm if fired early
+    if datetime.now() < target:
+        schedule_auto_clear(target)
         return
-    # Check if it's March 1st or October 1st
-    if (current_date.month == 3 and current_date.day == 1) or \
-            (current_date.month == 10 and current_date.day == 1):
-        print(f"Auto-clearing all monitoring on {current_date}")
+
+    try:
+        print(f"Auto-clearing all monitoring for {target.date()}")
         with monitoring_lock:
             total_courses = sum(len(courses) for courses in monitoring_data.values())
             total_users = len(monitoring_data)
+            for poll in course_polls.values():
+                poll['timer'].cancel()
+            course_polls.clear()
             monitoring_data.clear()
         print(f"Cleared {total_courses} courses for {total_users} users")
-
-    # Update last check date
-    last_check_date = current_date
+    finally:
+        schedule_auto_clear()
 
 
-def auto_clear_scheduler():
-    """Background thread to periodically check for auto-clear"""
-    while True:
-        try:
-            check_and_clear_monitoring()
-            time.sleep(3600)
-        except Exception as e:
-            print(f"Error in auto-clear scheduler: {e}")
-            time.sleep(3600)
+# Arm the clear-out at import so it runs however the app is launched
+schedule_auto_clear()
 
 
 class CourseQuery:
@@ -81,7 +174,7 @@ class CourseQuery:
         try:
             # get login page
             login_url = "https://web.sys.scu.edu.tw/logins.asp"
-            self.session.get(login_url)
+            self.session.get(login_url, timeout=REQUEST_TIMEOUT)
 
             # Submit login form
             login_data = {
@@ -90,7 +183,7 @@ class CourseQuery:
             }
 
             submit_url = "https://web.sys.scu.edu.tw/login0.asp"
-            response = self.session.post(submit_url, data=login_data)
+            response = self.session.post(submit_url, data=login_data, timeout=REQUEST_TIMEOUT)
             content = response.content.decode('big5', errors='ignore')
             if "登入成功" in content:
                 self.logged_in = True
@@ -115,7 +208,7 @@ class CourseQuery:
 
             # Visit the query page first
             query_page_url = "https://web.sys.scu.edu.tw/course201.asp"
-            self.session.get(query_page_url)
+            self.session.get(query_page_url, timeout=REQUEST_TIMEOUT)
 
             # Submit to course202.asp
             submit_url = "https://web.sys.scu.edu.tw/course202.asp"
@@ -126,7 +219,7 @@ class CourseQuery:
             }
 
             print(f"Submitting query data: {query_data}")
-            response = self.session.post(submit_url, data=query_data)
+            response = self.session.post(submit_url, data=query_data, timeout=REQUEST_TIMEOUT)
             content = response.content.decode('big5', errors='ignore')
 
             print(f"Received response, length: {len(content)} characters")
@@ -318,30 +411,53 @@ class CourseQuery:
 query = CourseQuery()
 
 
-def monitor_course(user_id, course_id, course_name):
-    """Background thread to monitor course availability"""
-    print(f"Starting to monitor course {course_id} ({course_name}) for user {user_id}")
+def is_active_poll(course_id, poll):
+    """Check that poll is still the active poll for course_id (caller holds monitoring_lock)"""
+    return course_polls.get(course_id) is poll
 
-    while True:
-        try:
-            # Check for auto-clear
-            check_and_clear_monitoring()
 
-            # Check if still in monitoring list
-            with monitoring_lock:
-                if (user_id not in monitoring_data or
-                        course_id not in monitoring_data[user_id]):
-                    print(f"Course {course_id} removed from monitoring, stopping thread")
-                    break
+def remove_user_course(user_id, course_id):
+    """Remove one monitored course of a user (caller holds monitoring_lock)"""
+    entry = monitoring_data[user_id].pop(course_id)
+    if not monitoring_data[user_id]:  # If user has no other monitored courses
+        del monitoring_data[user_id]
+
+    poll = course_polls.get(course_id)
+    if poll:
+        poll['users'].discard(user_id)
+        if not poll['users']:  # If no other user monitors this course
+            poll['timer'].cancel()
+            del course_polls[course_id]
+    return entry
 
-            # Query course status
-            result = query.query_course(course_id)
 
-            if result and not result.get("error"):
-                available = result.get("available", 0)
+def poll_course(course_id, poll, failures=0):
+    """Scheduled task that checks course availability once for all its users"""
+    # Check if still monitored by anyone
+    with monitoring_lock:
+        if not is_active_poll(course_id, poll):
+            print(f"Course {course_id} removed from monitoring, stopping polls")
+            return
+
+    delay = MONITOR_INTERVAL
+    try:
+        # Query course status
+        result = query.query_course(course_id)
 
-                if available > 0:
-                    # Slots available! Send notification
+        if result and not result.get("error"):
+            failures = 0
+            available = result.get("available", 0)
+
+            if available > 0:
+                # Remove monitoring first, so cancelled or cleared courses are never notified
+                with monitoring_lock:
+                    if not is_active_poll(course_id, poll):
+                        return
+                    recipients = [(user_id, remove_user_course(user_id, course_id)['course_name'])
+                                  for user_id in list(poll['users'])]
+
+                # Slots available! Send notification
+                for user_id, course_name in recipients:
                     notification = f"""好消息！課程有名額了！
 
 課程名稱：{course_name}
@@ -358,27 +474,26 @@ def monitor_course(user_id, course_id, course_name):
                     except Exception as e:
                         print(f"Failed to send notification: {e}")
 
-                    # Remove monitoring
-                    with monitoring_lock:
-                        if user_id in monitoring_data and course_id in monitoring_data[user_id]:
-                            del monitoring_data[user_id][course_id]
-                            if not monitoring_data[user_id]:  # If user has no other monitored courses
-                                del monitoring_data[user_id]
-
-                    break
-                else:
-                    print(f"Course {course_id} still has no slots available (remaining: {available})")
+                print(f"Stopped monitoring course {course_id}")
+                return
             else:
-                print(f"Failed to query course {course_id}: {result.get('error', 'Unknown error')}")
+                print(f"Course {course_id} still has no slots available (remaining: {available})")
+        else:
+            failures += 1
+            print(f"Failed to query course {course_id}: {result.get('error', 'Unknown error')}")
 
-            # Wait 5 seconds before checking again
-            time.sleep(5)
+    except Exception as e:
+        failures += 1
+        print(f"Error while polling course {course_id}: {e}")
 
-        except Exception as e:
-            print(f"Error in monitoring thread: {e}")
-            time.sleep(5)
+    # Back off exponentially after consecutive failures
+    if failures:
+        delay = min(MONITOR_INTERVAL * 2 ** failures, MAX_BACKOFF_SECONDS)
 
-    print(f"Stopped monitoring course {course_id}")
+    # Schedule the next poll unless monitoring was cancelled meanwhile
+    with monitoring_lock:
+        if is_active_poll(course_id, poll):
+            poll['timer'] = scheduler.schedule(delay, poll_course, course_id, poll, failures)
 
 
 def start_monitoring(user_id, course_id, course_name):
@@ -387,23 +502,19 @@ def start_monitoring(user_id, course_id, course_name):
         if user_id not in monitoring_data:
             monitoring_data[user_id] = {}
 
-        # If already monitoring, don't start new thread
+        # If already monitoring, don't schedule another poll
         if course_id in monitoring_data[user_id]:
             return False  # Already monitoring
 
-        # Create and start monitoring thread
-        monitor_thread = threading.Thread(
-            target=monitor_course,
-            args=(user_id, course_id, course_name),
-            daemon=True
-        )
-
-        monitoring_data[user_id][course_id] = {
-            'course_name': course_name,
-            'thread': monitor_thread
-        }
+        print(f"Starting to monitor course {course_id} ({course_name}) for user {user_id}")
+        monitoring_data[user_id][course_id] = {'course_name': course_name}
 
-        monitor_thread.start()
+        # Share one poll between all users monitoring the same course
+        if course_id not in course_polls:
+            poll = {'users': set()}
+            poll['timer'] = scheduler.schedule(MONITOR_INTERVAL, poll_course, course_id, poll)
+            course_polls[course_id] = poll
+        course_polls[course_id]['users'].add(user_id)
         return True
 
 
@@ -414,17 +525,11 @@ def stop_monitoring(user_id, course_id=None):
             return None, 0
 
         if course_id is None:  # Cancel all
-            courses = monitoring_data[user_id].copy()
-            del monitoring_data[user_id]
-            return list(courses.values()), len(courses)
+            courses = [remove_user_course(user_id, course_id) for course_id in list(monitoring_data[user_id])]
+            return courses, len(courses)
         else:  # Cancel single course
             if course_id in monitoring_data[user_id]:
-                course_name = monitoring_data[user_id][course_id]['course_name']
-                del monitoring_data[user_id][course_id]
-
-                if not monitoring_data[user_id]:  # If user has no other monitored courses
-                    del monitoring_data[user_id]
-
+                course_name = remove_user_course(user_id, course_id)['course_name']
                 return course_name, 1
 
         return None, 0
@@ -643,10 +748,8 @@ if __name__ == "__main__":
     else:
         print("Login failed, please check environment variable settings")
 
-    # Start auto-clear scheduler
-    auto_clear_thread = threading.Thread(target=auto_clear_scheduler, daemon=True)
-    auto_clear_thread.start()
-    print("Auto-clear scheduler started")
+    # Timer scheduler is started on import with the semester auto-clear
+    print("Timer scheduler started")
     print("Monitoring feature activated")
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file